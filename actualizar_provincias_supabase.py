@@ -1,66 +1,124 @@
 """
 Script para agregar información de provincia a los registros de Supabase
 Obtiene estado/provincia desde Odoo basándose en partner_id
+
+Los partners con provincia quedan en una caché local y no se vuelven a pedir a Odoo;
+los que no tienen provincia se consultan en cada corrida. Si cambió la dirección de un
+partner que ya tenía provincia en Odoo, correr con --full-refresh.
 """
 import os
 import sys
+import pickle
+import httpx
 from dotenv import load_dotenv
 from odoo_manager import OdooManager
-from supabase_manager import SupabaseManager
+from supabase_manager import get_supabase_manager
 
 load_dotenv()
 
 # Verificar si se pasó --yes como argumento
 auto_confirm = '--yes' in sys.argv or '-y' in sys.argv
+# --full-refresh: ignorar la caché local y volver a leer todos los partners de Odoo
+full_refresh = '--full-refresh' in sys.argv
+
+# Partners por llamada a bulk_update_provincias si la llamada única con todo el mapa
+# excede el statement_timeout de Postgres
+BATCH_PARTNERS = 500
+
+# IDs por search_read a Odoo: un dominio con decenas de miles de ids en un solo
+# XML-RPC arma un request y una respuesta enormes
+ODOO_CHUNK = 5000
+
+# Caché local {partner_id: {state_id, state_name, city}}, solo de partners con provincia:
+# las direcciones cambian poco, así que en cada corrida solo se consulta a Odoo por los
+# partners nuevos o que aún no tenían provincia
+CACHE_PARTNERS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '__pycache__', 'dashboard_cache', 'odoo_partner_provincias.pkl'
+)
 
 print("🚀 Iniciando actualización de provincias en Supabase...")
 print("=" * 80)
 
 # Conectar a Odoo y Supabase
 odoo_manager = OdooManager()
-supabase_manager = SupabaseManager()
+supabase_manager = get_supabase_manager()
 
 # Obtener lista de partner_ids únicos en Supabase 2025
 print("\n📊 Paso 1: Obteniendo lista de clientes en Supabase...")
-result = supabase_manager.supabase.table('ventas_odoo_2025')\
-    .select('id, partner_id')\
-    .execute()
+try:
+    # DISTINCT en Postgres (RPC partner_line_counts): vuelven los partners con su número
+    # de líneas, no todas las líneas de la tabla
+    conteos = supabase_manager.supabase.rpc('partner_line_counts', {'p_table': 'ventas_odoo_2025'}).execute().data or {}
+    total_registros = int(conteos.get('total') or 0)
+    lineas_por_partner = {int(pid): int(n) for pid, n in (conteos.get('partners') or {}).items()}
+except Exception as e:
+    print(f"   ⚠️ RPC partner_line_counts no disponible ({e}), leyendo líneas")
+    # Paginación keyset por id (WHERE id > último ORDER BY id LIMIT n): un select sin
+    # paginar se corta en el "Max rows" de PostgREST (1000) y OFFSET se vuelve más
+    # lento en cada página
+    total_registros = 0
+    lineas_por_partner = {}
+    for page in supabase_manager.iter_pages('ventas_odoo_2025', 'partner_id'):
+        total_registros += len(page)
+        for r in page:
+            if r.get('partner_id'):
+                lineas_por_partner[r['partner_id']] = lineas_por_partner.get(r['partner_id'], 0) + 1
 
-if not result.data:
+if not total_registros:
     print("❌ No se encontraron registros en Supabase")
     exit(1)
 
 # Obtener partner_ids únicos
-partner_ids = list(set([r['partner_id'] for r in result.data if r.get('partner_id')]))
+partner_ids = list(lineas_por_partner)
 print(f"✅ Encontrados {len(partner_ids)} clientes únicos")
 
 # Obtener información de estado/provincia de Odoo
 print("\n📊 Paso 2: Obteniendo información de estado/provincia desde Odoo...")
-print(f"   Consultando {len(partner_ids)} partners...")
 
 try:
-    partners_data = odoo_manager.models.execute_kw(
-        odoo_manager.db, odoo_manager.uid, odoo_manager.password,
-        'res.partner', 'search_read',
-        [[('id', 'in', partner_ids)]],
-        {'fields': ['id', 'name', 'state_id', 'city']}
-    )
+    cache_partners = {}
+    if not full_refresh and os.path.exists(CACHE_PARTNERS):
+        try:
+            with open(CACHE_PARTNERS, 'rb') as f:
+                # Sin los None de cachés anteriores (partners que entonces no tenían provincia)
+                cache_partners = {pid: info for pid, info in pickle.load(f).items() if info}
+        except Exception as e:
+            print(f"   ⚠️ Caché local de partners ilegible ({e}), se consulta todo a Odoo")
     
-    print(f"✅ Obtenidos {len(partners_data)} partners con información")
+    faltantes = [partner_id for partner_id in partner_ids if partner_id not in cache_partners]
+    print(f"   Consultando {len(faltantes)} partners ({len(partner_ids) - len(faltantes)} desde caché local)...")
     
-    # Crear diccionario de mapeo
-    partner_state_map = {}
-    for partner in partners_data:
-        partner_id = partner['id']
-        state_info = partner.get('state_id')
-        city = partner.get('city')
+    for inicio in range(0, len(faltantes), ODOO_CHUNK):
+        chunk = faltantes[inicio:inicio + ODOO_CHUNK]
+        partners_data = odoo_manager.models.execute_kw(
+            odoo_manager.db, odoo_manager.uid, odoo_manager.password,
+            'res.partner', 'search_read',
+            [[('id', 'in', chunk)]],
+            {'fields': ['id', 'state_id', 'city']}
+        )
+        # Partners sin provincia (o que Odoo no devuelve) no se guardan: completar su
+        # dirección en Odoo es el motivo típico para volver a correr el script
+        for partner in partners_data:
+            state_info = partner.get('state_id')
+            if state_info and isinstance(state_info, list) and len(state_info) > 1:
+                cache_partners[partner['id']] = {
+                    'state_id': state_info[0],
+                    'state_name': state_info[1],
+                    'city': partner.get('city') or ''
+                }
         
-        if state_info and isinstance(state_info, list) and len(state_info) > 1:
-            partner_state_map[partner_id] = {
-                'state_id': state_info[0],
-                'state_name': state_info[1],
-                'city': city or ''
-            }
+        # Guardar después de cada chunk: si el script se corta, la próxima corrida sigue
+        os.makedirs(os.path.dirname(CACHE_PARTNERS), exist_ok=True)
+        with open(CACHE_PARTNERS, 'wb') as f:
+            pickle.dump(cache_partners, f, protocol=pickle.HIGHEST_PROTOCOL)
+    
+    print(f"✅ Información de {len(partner_ids)} partners lista")
+    
+    # Crear diccionario de mapeo
+    partner_state_map = {
+        partner_id: cache_partners[partner_id]
+        for partner_id in partner_ids if cache_partners.get(partner_id)
+    }
     
     print(f"✅ Mapeados {len(partner_state_map)} partners con estado/provincia")
     
@@ -72,7 +130,7 @@ try:
     # Confirmar antes de actualizar
     print(f"\n{'='*80}")
     print(f"📋 RESUMEN:")
-    print(f"   • Registros en Supabase: {len(result.data)}")
+    print(f"   • Registros en Supabase: {total_registros}")
     print(f"   • Partners únicos: {len(partner_ids)}")
     print(f"   • Partners con provincia: {len(partner_state_map)}")
     print(f"{'='*80}")
@@ -119,44 +177,90 @@ CREATE INDEX IF NOT EXISTS idx_ventas_2025_state ON ventas_odoo_2025(state_id);
         print("\n✅ Las columnas ya existen en Supabase")
         print("\n📊 Paso 3: Actualizando registros...")
         
-        # Agrupar registros por partner_id para actualizar en lotes
-        records_by_partner = {}
-        for record in result.data:
-            partner_id = record.get('partner_id')
-            if partner_id:
-                if partner_id not in records_by_partner:
-                    records_by_partner[partner_id] = []
-                records_by_partner[partner_id].append(record['id'])
-        
         total_updated = 0
-        total_partners = len(records_by_partner)
+        total_modificados = 0  # solo RPC: líneas cuyo valor cambió (las demás no se reescriben)
+        total_partners = len(lineas_por_partner)
+        
+        # UPDATE en Postgres (RPC bulk_update_provincias, ver supabase_optimizaciones.sql)
+        # en lugar de un request HTTP por partner. Primero todo el mapa en una sola
+        # llamada: un único UPDATE en una transacción (un commit y un flush de WAL, no
+        # uno por lote). Si Postgres lo corta por statement_timeout (57014) no quedó nada
+        # aplicado y se reintenta en lotes de BATCH_PARTNERS. Solo se reenvía si el request
+        # no llegó (429, conexión: ver SupabaseManager.bulk_update_provincias); el UPDATE
+        # por partner (miles de requests) queda para cuando la función no está creada
+        # (PGRST202).
+        payload = [
+            {'partner_id': partner_id, **partner_state_map[partner_id]}
+            for partner_id in lineas_por_partner if partner_id in partner_state_map
+        ]
+        pendientes = []
+        abortado = False
+        inicio = 0
+        tamaño_lote = max(len(payload), 1)
+        while inicio < len(payload):
+            lote = payload[inicio:inicio + tamaño_lote]
+            try:
+                total_modificados += supabase_manager.bulk_update_provincias(lote)
+                total_updated += sum(lineas_por_partner[item['partner_id']] for item in lote)
+                inicio += len(lote)
+            except Exception as e:
+                codigo = getattr(e, 'code', None)
+                if codigo == '57014' and tamaño_lote > BATCH_PARTNERS:
+                    print(f"\n   ⚠️ UPDATE único excedió statement_timeout, reintentando en lotes de {BATCH_PARTNERS}")
+                    tamaño_lote = BATCH_PARTNERS
+                    continue
+                if codigo == 'PGRST202':
+                    print(f"\n   ⚠️ RPC bulk_update_provincias no existe ({e}), actualizando por partner")
+                    pendientes = [item['partner_id'] for item in payload[inicio:]]
+                elif str(codigo) in ('57014', '502', '503', '504') or isinstance(e, httpx.TimeoutException):
+                    # Tras un timeout (del cliente o del gateway: 502/504) el UPDATE puede
+                    # seguir y confirmarse en el servidor: no se repite ni se pasa a partner
+                    # por partner
+                    print(f"\n   ❌ bulk_update_provincias no respondió a tiempo ({e}); puede seguir aplicándose en Postgres")
+                    print("   El UPDATE es idempotente: vuelve a ejecutar el script para completar la actualización")
+                    abortado = True
+                else:
+                    print(f"\n   ❌ Error en bulk_update_provincias: {e}")
+                    abortado = True
+                break
+            print(f"   📦 Procesados {inicio}/{len(payload)} partners ({total_updated} registros actualizados)", end='\r')
         
-        for idx, (partner_id, record_ids) in enumerate(records_by_partner.items(), 1):
-            if partner_id in partner_state_map:
-                state_info = partner_state_map[partner_id]
+        for idx, partner_id in enumerate(pendientes, 1):
+            state_info = partner_state_map[partner_id]
+            
+            try:
+                # Actualizar todos los registros de este partner de una vez (por partner_id,
+                # sin mandar la lista de ids de línea en la URL)
+                supabase_manager.supabase.table('ventas_odoo_2025')\
+                    .update({
+                        'state_id': state_info['state_id'],
+                        'state_name': state_info['state_name'],
+                        'city': state_info['city']
+                    }, returning='minimal')\
+                    .eq('partner_id', partner_id)\
+                    .execute()
+                
+                total_updated += lineas_por_partner[partner_id]
                 
-                try:
-                    # Actualizar todos los registros de este partner de una vez
-                    supabase_manager.supabase.table('ventas_odoo_2025')\
-                        .update({
-                            'state_id': state_info['state_id'],
-                            'state_name': state_info['state_name'],
-                            'city': state_info['city']
-                        })\
-                        .in_('id', record_ids)\
-                        .execute()
-                    
-                    total_updated += len(record_ids)
-                    
-                except Exception as e:
-                    print(f"\n   ⚠️ Error actualizando partner {partner_id}: {e}")
+            except Exception as e:
+                print(f"\n   ⚠️ Error actualizando partner {partner_id}: {e}")
             
-            print(f"   📦 Procesados {idx}/{total_partners} partners ({total_updated} registros actualizados)", end='\r')
+            print(f"   📦 Procesados {idx}/{len(pendientes)} partners ({total_updated} registros actualizados)", end='\r')
+        
+        # Las consultas cacheadas (memo SQLite incluido) tienen las provincias anteriores
+        # (también si se abortó: los lotes anteriores ya quedaron aplicados)
+        supabase_manager.invalidate_cache()
+        
+        if abortado:
+            print(f"\n❌ Actualización incompleta: {inicio}/{len(payload)} partners aplicados")
+            exit(1)
         
         print(f"\n\n✅ Actualización completada")
         print(f"   • Partners procesados: {total_partners}")
         print(f"   • Registros actualizados: {total_updated}")
-        print(f"   • Registros sin provincia: {len(result.data) - total_updated}")
+        if total_modificados:
+            print(f"   • Registros con provincia/ciudad nueva: {total_modificados}")
+        print(f"   • Registros sin provincia: {total_registros - total_updated}")
     
 except Exception as e:
     print(f"❌ Error: {e}")
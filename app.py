@@ -15,6 +15,7 @@ from odoo_manager import OdooManager
 from google_sheets_manager import GoogleSheetsManager
 import os
 import pandas as pd
+import numpy as np
 import json
 import io
 import calendar
@@ -30,8 +31,8 @@ app = Flask(__name__)
 
 # --- Configuración de Supabase (Datos Históricos) ---
 try:
-    from supabase_manager import SupabaseManager
-    supabase_manager = SupabaseManager()
+    from supabase_manager import get_supabase_manager
+    supabase_manager = get_supabase_manager()
     SUPABASE_ENABLED = True
     print("✅ Supabase habilitado para datos históricos")
 except Exception as e:
@@ -3834,7 +3835,10 @@ def api_mapa_ventas():
 
         if source == 'supabase':
             print(f"🗺️ Obteniendo datos del mapa desde Supabase ({año}-{mes:02d})")
-            sales_data = supabase_manager.get_sales_data(fecha_inicio, fecha_fin)
+            sales_data = supabase_manager.get_sales_data(
+                fecha_inicio, fecha_fin,
+                select='partner_id,partner_name,state_id,state_name,balance,price_subtotal'
+            )
         else:
             print(f"🗺️ Obteniendo datos del mapa desde Odoo ({año}-{mes:02d})")
             sales_data = data_manager.get_sales_lines(date_from=fecha_inicio, date_to=fecha_fin, limit=SALES_LIMIT)
@@ -4102,7 +4106,7 @@ def api_cobertura_filtrada():
         source = get_data_source(año_int, mes_int)
 
         if source != 'odoo':
-            # Para Supabase, calcular cobertura usando campo 'canal'
+            # Para Supabase, calcular cobertura usando el canal de venta (sales_channel_name)
             print(f"📊 Año {año_int} usa Supabase - calculando cobertura por canal")
             
             # Obtener clientes activos y cartera desde Supabase
@@ -4110,59 +4114,31 @@ def api_cobertura_filtrada():
             fecha_fin_str = fecha_fin.strftime('%Y-%m-%d')
             fecha_inicio_ano_str = fecha_inicio_ano.strftime('%Y-%m-%d')
             
-            # Cartera del año
-            ventas_ano = supabase_manager.get_sales_data(fecha_inicio_ano_str, fecha_fin_str)
-            cartera_ids = set(v.get('partner_id') for v in ventas_ano if v.get('partner_id'))
-            
-            # Activos del mes
-            ventas_mes = supabase_manager.get_sales_data(fecha_inicio_str, fecha_fin_str)
-            activos_ids = set(v.get('partner_id') for v in ventas_mes if v.get('partner_id'))
+            # Cartera del año y activos del mes en una sola consulta (el mes es el final
+            # del rango anual), como DataFrame: canal como category, sin una lista de dicts
+            ventas_ano = supabase_manager.get_sales_frame(
+                fecha_inicio_ano_str, fecha_fin_str, columns='invoice_date,partner_id,sales_channel_name'
+            )
+            ventas_ano = ventas_ano[ventas_ano['partner_id'].notna() & (ventas_ano['partner_id'] != 0)]
+            
+            # Clasificar en DIGITAL o NACIONAL (una vez por canal distinto, no por línea)
+            canales = ventas_ano['sales_channel_name'].astype('category').cat
+            es_digital = np.array([
+                any(clave in str(canal).upper() for clave in ('ECOMMERCE', 'AIRBNB', 'EMPLEADO'))
+                for canal in canales.categories
+            ] + [False], dtype=bool)  # código -1 (sin canal) -> NACIONAL
+            ventas_ano = ventas_ano.assign(
+                grupo=np.where(es_digital[canales.codes.to_numpy()], 'DIGITAL', 'NACIONAL')
+            )
             
-            # Agrupar por canal
-            cartera_por_canal = {}
-            activos_por_canal = {}
+            # Aplicar filtro
+            if canal_filtro != 'TODOS':
+                ventas_ano = ventas_ano[ventas_ano['grupo'] == canal_filtro]
+            ventas_mes = ventas_ano[ventas_ano['invoice_date'] >= fecha_inicio_str]
             
-            for venta in ventas_ano:
-                canal = venta.get('canal', 'SIN CANAL')
-                partner_id = venta.get('partner_id')
-                if not partner_id:
-                    continue
-                
-                # Clasificar en DIGITAL o NACIONAL
-                canal_upper = str(canal).upper()
-                if 'ECOMMERCE' in canal_upper or 'AIRBNB' in canal_upper or 'EMPLEADO' in canal_upper:
-                    grupo_clasificado = 'DIGITAL'
-                else:
-                    grupo_clasificado = 'NACIONAL'
-                
-                # Aplicar filtro
-                if canal_filtro != 'TODOS' and grupo_clasificado != canal_filtro:
-                    continue
-                
-                if grupo_clasificado not in cartera_por_canal:
-                    cartera_por_canal[grupo_clasificado] = set()
-                cartera_por_canal[grupo_clasificado].add(partner_id)
-            
-            for venta in ventas_mes:
-                canal = venta.get('canal', 'SIN CANAL')
-                partner_id = venta.get('partner_id')
-                if not partner_id:
-                    continue
-                
-                # Clasificar en DIGITAL o NACIONAL
-                canal_upper = str(canal).upper()
-                if 'ECOMMERCE' in canal_upper or 'AIRBNB' in canal_upper or 'EMPLEADO' in canal_upper:
-                    grupo_clasificado = 'DIGITAL'
-                else:
-                    grupo_clasificado = 'NACIONAL'
-                
-                # Aplicar filtro
-                if canal_filtro != 'TODOS' and grupo_clasificado != canal_filtro:
-                    continue
-                
-                if grupo_clasificado not in activos_por_canal:
-                    activos_por_canal[grupo_clasificado] = set()
-                activos_por_canal[grupo_clasificado].add(partner_id)
+            # Agrupar por canal: clientes únicos por grupo
+            cartera_por_canal = ventas_ano.groupby('grupo')['partner_id'].nunique().to_dict()
+            activos_por_canal = ventas_mes.groupby('grupo')['partner_id'].nunique().to_dict()
             
             # Construir respuesta
             datos_grupos = []
@@ -4170,8 +4146,8 @@ def api_cobertura_filtrada():
             total_activos_global = 0
             
             for grupo in sorted(cartera_por_canal.keys()):
-                cartera_count = len(cartera_por_canal.get(grupo, set()))
-                activos_count = len(activos_por_canal.get(grupo, set()))
+                cartera_count = cartera_por_canal.get(grupo, 0)
+                activos_count = activos_por_canal.get(grupo, 0)
                 cobertura = (activos_count / cartera_count * 100) if cartera_count > 0 else 0
                 
                 datos_grupos.append({
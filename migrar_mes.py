@@ -38,7 +38,7 @@ except ImportError:
     pass
 
 from odoo_manager import OdooManager
-from supabase_manager import SupabaseManager
+from supabase_manager import get_supabase_manager
 
 def _rel(valor):
     """Aplana un campo relacional Odoo [id, 'nombre'] -> (id, nombre)."""
@@ -230,21 +230,18 @@ def migrar_mes(odoo, supabase_mgr, anio, mes, dry_run=False, auto_yes=False):
         supabase_mgr.supabase.table(tabla).insert(lote).execute()
         insertados += len(lote)
         print(f"   ✅ {insertados}/{len(filas)}")
+    supabase_mgr.invalidate(anio)
+    if not supabase_mgr.refresh_monthly_rollup():
+        # Sin refresco, las tendencias mensuales seguirían mostrando los totales anteriores
+        print("❌ Datos cargados, pero mv_sales_by_month NO se refrescó.")
+        print("   Vuelve a ejecutar con la clave service_role en SUPABASE_KEY "
+              "(o SELECT refresh_mv_sales_by_month(); en el SQL Editor).")
+        sys.exit(1)
 
     # 4) Verificación de totales
     total_sb = 0.0
-    page, offset = 1000, 0
-    while True:
-        res = supabase_mgr.supabase.table(tabla)\
-            .select('price_subtotal')\
-            .gte('invoice_date', fecha_inicio).lte('invoice_date', fecha_fin)\
-            .range(offset, offset + page - 1).execute()
-        if not res.data:
-            break
-        total_sb += sum(float(x['price_subtotal'] or 0) for x in res.data)
-        if len(res.data) < page:
-            break
-        offset += page
+    for page in supabase_mgr.iter_pages(tabla, 'price_subtotal', fecha_inicio, fecha_fin):
+        total_sb += sum(float(x['price_subtotal'] or 0) for x in page)
 
     diff = abs(total_odoo - total_sb)
     print("-" * 80)
@@ -290,7 +287,7 @@ def main():
     if not odoo.uid:
         print("❌ No se pudo conectar a Odoo.")
         return
-    supabase_mgr = SupabaseManager()
+    supabase_mgr = get_supabase_manager()
 
     for anio, mes in objetivo:
         migrar_mes(odoo, supabase_mgr, anio, mes, dry_run=dry_run, auto_yes=auto_yes)
@@ -3,10 +3,124 @@ Script para sincronizar datos de 2025 desde Odoo a Supabase
 Obtiene todos los registros de 2025 de Odoo y los inserta en Supabase
 """
 
+import os
+import sys
+from itertools import islice
 from odoo_manager import OdooManager
-from supabase_manager import SupabaseManager
+from supabase_manager import get_supabase_manager
 from datetime import datetime
 
+# Conexión directa a Postgres (opcional): si hay SUPABASE_DB_URL y psycopg instalado
+# (pip install "psycopg[binary]"), el reemplazo de 2025 se hace con un DELETE + COPY en
+# una sola transacción en lugar de cientos de POST a PostgREST.
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+COPY_COLUMNS = (
+    'odoo_id', 'invoice_date', 'invoice_name', 'partner_id', 'partner_name',
+    'product_id', 'product_name', 'product_code', 'commercial_line_name',
+    'quantity', 'price_unit', 'price_subtotal'
+)
+
+
+def reemplazar_con_copy(db_url, records, fecha_inicio, fecha_fin):
+    """Borra el rango e inserta los registros con COPY, todo en una transacción."""
+    with psycopg.connect(db_url) as conn, conn.cursor() as cur:
+        cur.execute(
+            "DELETE FROM sales_lines WHERE invoice_date BETWEEN %s AND %s",
+            (fecha_inicio, fecha_fin)
+        )
+        copiados = 0
+        with cur.copy(f"COPY sales_lines ({', '.join(COPY_COLUMNS)}) FROM STDIN") as copy:
+            for r in records:
+                copy.write_row(tuple(r[c] for c in COPY_COLUMNS))
+                copiados += 1
+    return copiados
+
+
+def iter_records(all_lines, move_data, product_data, partner_data, stats):
+    """
+    Genera los registros de sales_lines uno por uno a partir de las líneas de Odoo.
+    
+    Las líneas omitidas se cuentan en stats['skipped'] y los errores se acumulan en
+    stats['errores'] como (id_línea, error).
+    """
+    for line in all_lines:
+        try:
+            move_id = line.get('move_id')[0] if line.get('move_id') else None
+            product_id = line.get('product_id')[0] if line.get('product_id') else None
+            partner_id = line.get('partner_id')[0] if line.get('partner_id') else None
+            
+            if not all([move_id, product_id, partner_id]):
+                stats['skipped'] += 1
+                continue
+            
+            move = move_data.get(move_id, {})
+            product = product_data.get(product_id, {})
+            partner = partner_data.get(partner_id, {})
+            
+            invoice_date = move.get('invoice_date')
+            if not invoice_date:
+                stats['skipped'] += 1
+                continue
+            
+            commercial_line = product.get('commercial_line_national_id')
+            commercial_line_name = commercial_line[1] if commercial_line and isinstance(commercial_line, list) else ''
+            
+            # Balance debe ser != 0
+            balance = line.get('balance', 0)
+            if balance == 0:
+                stats['skipped'] += 1
+                continue
+            
+            record = {
+                'odoo_id': line['id'],
+                'invoice_date': invoice_date,
+                'invoice_name': move.get('name', ''),
+                'partner_id': partner_id,
+                'partner_name': partner.get('name', ''),
+                'product_id': product_id,
+                'product_name': product.get('name', ''),
+                'product_code': product.get('default_code', ''),
+                'commercial_line_name': commercial_line_name,
+                'quantity': float(line.get('quantity', 0)),
+                'price_unit': float(line.get('price_unit', 0)),
+                'price_subtotal': abs(float(balance))  # Usar valor absoluto del balance
+            }
+            
+        except Exception as e:
+            stats['errores'].append((line.get('id'), e))
+            stats['skipped'] += 1
+            continue
+        
+        yield record
+
+
+def insertar_lote(supabase_mgr, tabla, lote):
+    """
+    Inserta un lote en PostgREST. Con orjson serializa el JSON directamente (mucho más
+    rápido que el json estándar que usa supabase-py) y pide return=minimal para no
+    recibir las filas de vuelta.
+    """
+    if orjson is None:
+        supabase_mgr.supabase.table(tabla).insert(lote).execute()
+        return
+    
+    response = supabase_mgr.supabase.postgrest.session.post(
+        tabla,
+        content=orjson.dumps(lote),
+        headers={'Content-Type': 'application/json', 'Prefer': 'return=minimal'}
+    )
+    response.raise_for_status()
+
+
 def main():
     print("=" * 80)
     print("🔄 SINCRONIZACIÓN ODOO → SUPABASE (Año 2025)")
@@ -14,7 +128,7 @@ def main():
     
     # Inicializar managers
     odoo = OdooManager()
-    supabase_mgr = SupabaseManager()
+    supabase_mgr = get_supabase_manager()
     
     if not odoo.uid:
         print("❌ No se pudo conectar a Odoo")
@@ -68,7 +182,9 @@ def main():
     # Paso 3: Obtener datos completos en lotes
     print(f"\n📊 PASO 3: Obteniendo datos completos de Odoo...")
     batch_size = 500
-    all_lines = []
+    # Tamaño conocido tras el search: reservar la lista una vez en lugar de crecer con extend()
+    all_lines = [None] * total_odoo
+    pos = 0
     
     for i in range(0, total_odoo, batch_size):
         batch_ids = ids_odoo[i:i+batch_size]
@@ -81,11 +197,14 @@ def main():
             {
                 'fields': [
                     'id', 'move_id', 'partner_id', 'product_id', 'balance',
-                    'move_name', 'quantity', 'price_unit', 'display_name'
+                    'move_name', 'quantity', 'price_unit'
                 ]
             }
         )
-        all_lines.extend(lines)
+        all_lines[pos:pos + len(lines)] = lines
+        pos += len(lines)
+    
+    del all_lines[pos:]  # Por si Odoo devolvió menos líneas que IDs
     
     print(f"   ✅ Datos completos obtenidos: {len(all_lines)} líneas")
     
@@ -98,109 +217,53 @@ def main():
     
     print(f"   📦 {len(move_ids)} facturas, {len(product_ids)} productos, {len(partner_ids)} clientes")
     
-    # Obtener facturas
-    print("   📅 Obteniendo facturas...")
-    move_data = {}
-    for i in range(0, len(move_ids), batch_size):
-        batch = move_ids[i:i+batch_size]
-        moves = odoo.models.execute_kw(
+    # Una sola llamada search_read por modelo (mismo patrón que OdooManager.get_sales_lines)
+    # en lugar de un read por cada lote de 500 IDs. Odoo 16 no acepta rutas con punto
+    # ('move_id.invoice_date') en los fields de read/search_read, así que los tres modelos
+    # relacionados se siguen pidiendo aparte.
+    def leer_por_ids(modelo, ids, fields):
+        registros = odoo.models.execute_kw(
             odoo.db, odoo.uid, odoo.password,
-            'account.move', 'read',
-            [batch],
-            {'fields': ['id', 'invoice_date', 'name', 'state', 'invoice_origin', 'sales_channel_id']}
+            modelo, 'search_read',
+            [[('id', 'in', ids)]],
+            # A diferencia de read, search_read filtra archivados: mantener productos/clientes inactivos
+            {'fields': fields, 'context': {'active_test': False}}
         )
-        for m in moves:
-            move_data[m['id']] = m
+        return {r['id']: r for r in registros}
+    
+    # Obtener facturas
+    print("   📅 Obteniendo facturas...")
+    # Solo lo que usa el Paso 5 ('state' ya viene fijado a 'posted' por el dominio)
+    move_data = leer_por_ids('account.move', move_ids, ['id', 'invoice_date', 'name'])
     
     # Obtener productos
     print("   📦 Obteniendo productos...")
-    product_data = {}
-    for i in range(0, len(product_ids), batch_size):
-        batch = product_ids[i:i+batch_size]
-        products = odoo.models.execute_kw(
-            odoo.db, odoo.uid, odoo.password,
-            'product.product', 'read',
-            [batch],
-            {'fields': ['id', 'name', 'default_code', 'commercial_line_national_id']}
-        )
-        for p in products:
-            product_data[p['id']] = p
+    product_data = leer_por_ids('product.product', product_ids,
+                                ['id', 'name', 'default_code', 'commercial_line_national_id'])
     
     # Obtener clientes
     print("   👥 Obteniendo clientes...")
-    partner_data = {}
-    for i in range(0, len(partner_ids), batch_size):
-        batch = partner_ids[i:i+batch_size]
-        partners = odoo.models.execute_kw(
-            odoo.db, odoo.uid, odoo.password,
-            'res.partner', 'read',
-            [batch],
-            {'fields': ['id', 'name', 'vat']}
-        )
-        for p in partners:
-            partner_data[p['id']] = p
+    partner_data = leer_por_ids('res.partner', partner_ids, ['id', 'name', 'vat'])
     
     print("   ✅ Información relacionada obtenida")
     
-    # Paso 5: Preparar datos para inserción
+    # Paso 5: Preparar datos para inserción (primera pasada: solo conteo y total,
+    # los registros se vuelven a generar al insertar en lugar de guardarlos todos)
     print(f"\n📊 PASO 5: Preparando datos para inserción...")
-    records_to_insert = []
-    skipped = 0
+    stats = {'skipped': 0, 'errores': []}
+    total_registros = 0
+    total_ventas = 0
     
-    for line in all_lines:
-        try:
-            move_id = line.get('move_id')[0] if line.get('move_id') else None
-            product_id = line.get('product_id')[0] if line.get('product_id') else None
-            partner_id = line.get('partner_id')[0] if line.get('partner_id') else None
-            
-            if not all([move_id, product_id, partner_id]):
-                skipped += 1
-                continue
-            
-            move = move_data.get(move_id, {})
-            product = product_data.get(product_id, {})
-            partner = partner_data.get(partner_id, {})
-            
-            invoice_date = move.get('invoice_date')
-            if not invoice_date:
-                skipped += 1
-                continue
-            
-            commercial_line = product.get('commercial_line_national_id')
-            commercial_line_name = commercial_line[1] if commercial_line and isinstance(commercial_line, list) else ''
-            
-            # Balance debe ser != 0
-            balance = line.get('balance', 0)
-            if balance == 0:
-                skipped += 1
-                continue
-            
-            record = {
-                'odoo_id': line['id'],
-                'invoice_date': invoice_date,
-                'invoice_name': move.get('name', ''),
-                'partner_id': partner_id,
-                'partner_name': partner.get('name', ''),
-                'product_id': product_id,
-                'product_name': product.get('name', ''),
-                'product_code': product.get('default_code', ''),
-                'commercial_line_name': commercial_line_name,
-                'quantity': float(line.get('quantity', 0)),
-                'price_unit': float(line.get('price_unit', 0)),
-                'price_subtotal': abs(float(balance))  # Usar valor absoluto del balance
-            }
-            
-            records_to_insert.append(record)
-            
-        except Exception as e:
-            print(f"   ⚠️ Error procesando línea {line.get('id')}: {e}")
-            skipped += 1
+    for record in iter_records(all_lines, move_data, product_data, partner_data, stats):
+        total_registros += 1
+        total_ventas += record['price_subtotal']
     
-    print(f"   ✅ Registros preparados: {len(records_to_insert)}")
-    print(f"   ⚠️ Registros omitidos: {skipped}")
+    for line_id, error in stats['errores']:
+        print(f"   ⚠️ Error procesando línea {line_id}: {error}")
+    skipped = stats['skipped']
     
-    # Calcular total
-    total_ventas = sum(r['price_subtotal'] for r in records_to_insert)
+    print(f"   ✅ Registros preparados: {total_registros}")
+    print(f"   ⚠️ Registros omitidos: {skipped}")
     print(f"   💰 Total de ventas: S/ {total_ventas:,.2f}")
     
     # Paso 6: Confirmar antes de insertar
@@ -208,7 +271,7 @@ def main():
     print("📋 RESUMEN:")
     print(f"   • Registros actuales en Supabase: {current_count}")
     print(f"   • Registros en Odoo: {total_odoo}")
-    print(f"   • Registros a insertar: {len(records_to_insert)}")
+    print(f"   • Registros a insertar: {total_registros}")
     print(f"   • Total ventas: S/ {total_ventas:,.2f}")
     print(f"{'='*80}")
     
@@ -218,67 +281,74 @@ def main():
         print("\n❌ Operación cancelada")
         return
     
-    # Paso 7: Eliminar datos actuales
-    print(f"\n🗑️ PASO 6: Eliminando datos actuales de 2025 en Supabase...")
-    try:
-        delete_result = supabase_mgr.supabase.table('sales_lines')\
-            .delete()\
-            .gte('invoice_date', '2025-01-01')\
-            .lte('invoice_date', '2025-12-31')\
-            .execute()
-        print(f"   ✅ Datos antiguos eliminados")
-    except Exception as e:
-        print(f"   ⚠️ Error al eliminar: {e}")
-        print(f"   Continuando con inserción...")
-    
-    # Paso 8: Insertar nuevos datos en lotes
-    print(f"\n📥 PASO 7: Insertando datos en Supabase...")
-    insert_batch_size = 100
-    inserted = 0
-    errors = 0
-    
-    for i in range(0, len(records_to_insert), insert_batch_size):
-        batch = records_to_insert[i:i+insert_batch_size]
+    # Segunda pasada: los registros se generan a medida que se envían
+    records = iter_records(all_lines, move_data, product_data, partner_data, {'skipped': 0, 'errores': []})
+    
+    db_url = os.getenv('SUPABASE_DB_URL')
+    if db_url and psycopg:
+        # Paso 7+8: DELETE + COPY directo a Postgres (atómico)
+        print(f"\n📥 PASO 6-7: Reemplazando 2025 con DELETE + COPY directo a Postgres...")
+        try:
+            inserted = reemplazar_con_copy(db_url, records, '2025-01-01', '2025-12-31')
+            errors = 0
+            print(f"   ✅ {inserted} registros copiados")
+        except Exception as e:
+            print(f"   ❌ Error en COPY (la transacción se revirtió): {e}")
+            inserted = 0
+            errors = total_registros
+    else:
+        # Paso 7: Eliminar datos actuales
+        print(f"\n🗑️ PASO 6: Eliminando datos actuales de 2025 en Supabase...")
         try:
-            supabase_mgr.supabase.table('sales_lines').insert(batch).execute()
-            inserted += len(batch)
-            print(f"   ✅ Lote {i//insert_batch_size + 1}: {len(batch)} registros insertados ({inserted}/{len(records_to_insert)})")
+            delete_result = supabase_mgr.supabase.table('sales_lines')\
+                .delete()\
+                .gte('invoice_date', '2025-01-01')\
+                .lte('invoice_date', '2025-12-31')\
+                .execute()
+            print(f"   ✅ Datos antiguos eliminados")
         except Exception as e:
-            print(f"   ❌ Error en lote {i//insert_batch_size + 1}: {e}")
-            errors += len(batch)
+            print(f"   ⚠️ Error al eliminar: {e}")
+            print(f"   Continuando con inserción...")
+    
+        # Paso 8: Insertar nuevos datos en lotes
+        print(f"\n📥 PASO 7: Insertando datos en Supabase...")
+        insert_batch_size = 100
+        inserted = 0
+        errors = 0
+    
+        lote_num = 0
+        while True:
+            batch = list(islice(records, insert_batch_size))
+            if not batch:
+                break
+            lote_num += 1
+            try:
+                insertar_lote(supabase_mgr, 'sales_lines', batch)
+                inserted += len(batch)
+                print(f"   ✅ Lote {lote_num}: {len(batch)} registros insertados ({inserted}/{total_registros})")
+            except Exception as e:
+                print(f"   ❌ Error en lote {lote_num}: {e}")
+                errors += len(batch)
+    
+    # Los datos de 2025 cambiaron: no servir consultas cacheadas de antes del insert
+    supabase_mgr.invalidate(2025)
+    if not supabase_mgr.refresh_monthly_rollup():
+        # Sin refresco, las tendencias mensuales seguirían mostrando los totales anteriores
+        print("\n❌ Datos cargados, pero mv_sales_by_month NO se refrescó.")
+        print("   Ejecuta SELECT refresh_mv_sales_by_month(); en el SQL Editor o vuelve a "
+              "correr el script con la clave service_role en SUPABASE_KEY.")
+        sys.exit(1)
     
     # Paso 9: Verificar resultado final
     print(f"\n📊 PASO 8: Verificando resultado final...")
-    result_final = supabase_mgr.supabase.table('sales_lines')\
-        .select('price_subtotal', count='exact')\
-        .gte('invoice_date', '2025-01-01')\
-        .lte('invoice_date', '2025-12-31')\
-        .execute()
-    
-    final_count = result_final.count
-    
-    # Calcular total en Supabase
-    page_size = 1000
-    offset = 0
+    # Calcular total y número de registros en Supabase (paginación keyset, sin OFFSET).
+    # El recorrido ya pasa por todas las filas: contarlas aquí evita un count='exact' aparte
+    final_count = 0
     total_supabase = 0
     
-    while True:
-        result = supabase_mgr.supabase.table('sales_lines')\
-            .select('price_subtotal')\
-            .gte('invoice_date', '2025-01-01')\
-            .lte('invoice_date', '2025-12-31')\
-            .range(offset, offset + page_size - 1)\
-            .execute()
-        
-        if not result.data:
-            break
-        
-        total_supabase += sum(float(r['price_subtotal']) for r in result.data)
-        
-        if len(result.data) < page_size:
-            break
-        
-        offset += page_size
+    for page in supabase_mgr.iter_pages('sales_lines', 'price_subtotal', '2025-01-01', '2025-12-31'):
+        final_count += len(page)
+        total_supabase += sum(float(r['price_subtotal']) for r in page)
     
     print(f"\n{'='*80}")
     print("✅ SINCRONIZACIÓN COMPLETADA")
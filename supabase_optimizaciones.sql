@@ -0,0 +1,246 @@
+-- =====================================================
+-- OPTIMIZACIONES DE SUPABASE (índices y funciones)
+-- =====================================================
+-- Ejecutar en Supabase → SQL Editor. Es idempotente: se puede re-ejecutar.
+
+-- -----------------------------------------------------
+-- ÍNDICES
+-- -----------------------------------------------------
+-- Paginación keyset de SupabaseManager.iter_pages: ORDER BY invoice_date, id
+-- con (invoice_date, id) > (última fecha, último id).
+CREATE INDEX IF NOT EXISTS idx_sales_lines_invoice_date_id ON sales_lines(invoice_date, id);
+CREATE INDEX IF NOT EXISTS idx_ventas_2025_invoice_date_id ON ventas_odoo_2025(invoice_date, id);
+
+-- Conteos de clientes (sales_active_partners, active_partners_by_channel): índice que cubre
+-- rango de fechas + partner_id + canal, así COUNT(DISTINCT partner_id) se resuelve con un
+-- index-only scan sin leer las filas de la tabla (61 columnas).
+-- En producción con tráfico se puede crear con CREATE INDEX CONCURRENTLY (fuera de una
+-- transacción, una sentencia por vez en el SQL Editor).
+CREATE INDEX IF NOT EXISTS idx_sales_lines_fecha_partner
+    ON sales_lines(invoice_date, partner_id) INCLUDE (sales_channel_name);
+CREATE INDEX IF NOT EXISTS idx_ventas_2025_fecha_partner
+    ON ventas_odoo_2025(invoice_date, partner_id) INCLUDE (sales_channel_name);
+
+-- Venta por mes (sales_by_month y el refresh de mv_sales_by_month): el
+-- índice cubre fecha + los dos montos, así la suma del rango recorre el índice en orden
+-- de fecha con un index-only scan en lugar de leer las filas completas de la tabla.
+CREATE INDEX IF NOT EXISTS idx_sales_lines_fecha_montos
+    ON sales_lines(invoice_date) INCLUDE (balance, price_subtotal);
+CREATE INDEX IF NOT EXISTS idx_ventas_2025_fecha_montos
+    ON ventas_odoo_2025(invoice_date) INCLUDE (balance, price_subtotal);
+
+-- -----------------------------------------------------
+-- FUNCIONES (RPC)
+-- -----------------------------------------------------
+-- Las funciones reciben el nombre de la tabla porque el dashboard usa una tabla por
+-- año (ver SupabaseManager._get_table_for_year); solo se aceptan las tablas de ventas.
+
+-- ¿Hay al menos una venta en el año? EXISTS corta en la primera fila (sin COUNT).
+CREATE OR REPLACE FUNCTION year_exists(p_table text, p_year int)
+RETURNS boolean
+LANGUAGE plpgsql STABLE
+AS $$
+DECLARE
+    existe boolean;
+BEGIN
+    IF p_table NOT IN ('sales_lines', 'ventas_odoo_2025') THEN
+        RAISE EXCEPTION 'Tabla no permitida: %', p_table;
+    END IF;
+    EXECUTE format(
+        'SELECT EXISTS (SELECT 1 FROM %I WHERE invoice_date BETWEEN $1 AND $2)', p_table
+    ) INTO existe USING make_date(p_year, 1, 1), make_date(p_year, 12, 31);
+    RETURN existe;
+END;
+$$;
+
+-- Agregaciones del dashboard: devuelven un número o unas pocas filas en lugar de
+-- que PostgREST pagine todas las líneas del rango hacia Python.
+
+-- Clientes únicos con venta en el rango (get_active_partners_count, get_unique_clients_count)
+CREATE OR REPLACE FUNCTION sales_active_partners(p_table text, d1 date, d2 date)
+RETURNS bigint
+LANGUAGE plpgsql STABLE
+AS $$
+DECLARE
+    total bigint;
+BEGIN
+    IF p_table NOT IN ('sales_lines', 'ventas_odoo_2025') THEN
+        RAISE EXCEPTION 'Tabla no permitida: %', p_table;
+    END IF;
+    EXECUTE format(
+        'SELECT count(DISTINCT partner_id) FROM %I WHERE invoice_date BETWEEN $1 AND $2', p_table
+    ) INTO total USING d1, d2;
+    RETURN total;
+END;
+$$;
+
+-- Clientes únicos por canal (get_active_partners_by_channel)
+CREATE OR REPLACE FUNCTION active_partners_by_channel(p_table text, d1 date, d2 date)
+RETURNS TABLE(channel text, n bigint)
+LANGUAGE plpgsql STABLE
+AS $$
+BEGIN
+    IF p_table NOT IN ('sales_lines', 'ventas_odoo_2025') THEN
+        RAISE EXCEPTION 'Tabla no permitida: %', p_table;
+    END IF;
+    RETURN QUERY EXECUTE format(
+        'SELECT coalesce(nullif(sales_channel_name, ''''), ''SIN CANAL'')::text, count(DISTINCT partner_id)
+           FROM %I
+          WHERE invoice_date BETWEEN $1 AND $2 AND partner_id IS NOT NULL
+          GROUP BY 1', p_table
+    ) USING d1, d2;
+END;
+$$;
+
+-- Venta por mes (get_sales_by_month): balance si es distinto de 0, si no price_subtotal
+CREATE OR REPLACE FUNCTION sales_by_month(p_table text, d1 date, d2 date)
+RETURNS TABLE(year int, month int, total numeric)
+LANGUAGE plpgsql STABLE
+AS $$
+BEGIN
+    IF p_table NOT IN ('sales_lines', 'ventas_odoo_2025') THEN
+        RAISE EXCEPTION 'Tabla no permitida: %', p_table;
+    END IF;
+    RETURN QUERY EXECUTE format(
+        'SELECT extract(year FROM invoice_date)::int, extract(month FROM invoice_date)::int,
+                sum(coalesce(nullif(balance, 0), price_subtotal, 0))::numeric
+           FROM %I
+          WHERE invoice_date BETWEEN $1 AND $2
+          GROUP BY 1, 2
+          ORDER BY 1, 2', p_table
+    ) USING d1, d2;
+END;
+$$;
+
+-- Años con ventas en cada tabla (SupabaseManager._warm_year_cache).
+-- En lugar de un DISTINCT sobre toda la tabla, se toma min/max por el índice y se
+-- prueba cada año con EXISTS: unas pocas búsquedas en el índice (invoice_date, id).
+CREATE OR REPLACE FUNCTION years_present()
+RETURNS TABLE(table_name text, year int)
+LANGUAGE plpgsql STABLE
+AS $$
+DECLARE
+    t text;
+    y_min int;
+    y_max int;
+    existe boolean;
+BEGIN
+    FOREACH t IN ARRAY ARRAY['sales_lines', 'ventas_odoo_2025'] LOOP
+        EXECUTE format(
+            'SELECT extract(year FROM min(invoice_date))::int, extract(year FROM max(invoice_date))::int FROM %I', t
+        ) INTO y_min, y_max;
+        CONTINUE WHEN y_min IS NULL;
+        FOR y IN y_min..y_max LOOP
+            EXECUTE format(
+                'SELECT EXISTS (SELECT 1 FROM %I WHERE invoice_date BETWEEN $1 AND $2)', t
+            ) INTO existe USING make_date(y, 1, 1), make_date(y, 12, 31);
+            IF existe THEN
+                table_name := t;
+                year := y;
+                RETURN NEXT;
+            END IF;
+        END LOOP;
+    END LOOP;
+END;
+$$;
+
+-- -----------------------------------------------------
+-- VISTA MATERIALIZADA: venta por mes
+-- -----------------------------------------------------
+-- get_sales_by_month lee de aquí cuando pide meses completos: unas pocas filas en vez
+-- de agregar las líneas en cada render. Misma regla de monto que sales_by_month.
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_sales_by_month AS
+SELECT 'sales_lines'::text AS table_name,
+       date_trunc('month', invoice_date)::date AS month,
+       sum(coalesce(nullif(balance, 0), price_subtotal, 0))::numeric AS total
+  FROM sales_lines
+ GROUP BY 1, 2
+UNION ALL
+SELECT 'ventas_odoo_2025'::text,
+       date_trunc('month', invoice_date)::date,
+       sum(coalesce(nullif(balance, 0), price_subtotal, 0))::numeric
+  FROM ventas_odoo_2025
+ GROUP BY 1, 2;
+
+-- Índice único: lo usan las consultas por rango y lo exige REFRESH ... CONCURRENTLY
+CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_sales_by_month ON mv_sales_by_month(table_name, month);
+
+-- Refresco sin bloquear lecturas. Lo llaman los scripts de carga después de insertar
+-- (SupabaseManager.refresh_monthly_rollup); SECURITY DEFINER porque el refresh
+-- requiere ser dueño de la vista.
+CREATE OR REPLACE FUNCTION refresh_mv_sales_by_month()
+RETURNS void
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+BEGIN
+    REFRESH MATERIALIZED VIEW CONCURRENTLY mv_sales_by_month;
+END;
+$$;
+
+-- Supabase da EXECUTE a anon/authenticated sobre las funciones de public: con la clave
+-- del REST cualquiera podría lanzar refrescos de la tabla completa. Solo service_role
+-- (la clave con la que corren migrar_mes.py y sincronizar_2025_odoo_supabase.py).
+REVOKE EXECUTE ON FUNCTION refresh_mv_sales_by_month() FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION refresh_mv_sales_by_month() TO service_role;
+
+-- Refresco nocturno opcional, desactivado: hoy la vista solo se refresca al final de los
+-- scripts de carga. Para activarlo, habilitar pg_cron (Database → Extensions) y ejecutar:
+-- SELECT cron.schedule('refresh_mv_sales_by_month', '0 6 * * *', 'SELECT refresh_mv_sales_by_month()');
+
+-- -----------------------------------------------------
+-- ACTUALIZACIONES MASIVAS (scripts de mantenimiento)
+-- -----------------------------------------------------
+-- Provincia/ciudad por partner (actualizar_provincias_supabase.py): un solo UPDATE (una
+-- transacción) por llamada en vez de un request HTTP por partner; el script manda todo
+-- el mapa en una llamada y solo lo parte en lotes si excede el statement_timeout.
+-- payload = [{partner_id, state_id,
+-- state_name, city}, ...]. Las líneas que ya tienen esos valores no se reescriben (cada
+-- UPDATE en Postgres escribe una versión nueva de la fila aunque no cambie nada: WAL,
+-- filas muertas para el vacuum y reescritura de índices). Devuelve las filas modificadas.
+CREATE OR REPLACE FUNCTION bulk_update_provincias(payload jsonb)
+RETURNS bigint
+LANGUAGE sql
+AS $$
+    WITH actualizadas AS (
+        UPDATE ventas_odoo_2025 v
+           SET state_id = p.state_id,
+               state_name = p.state_name,
+               city = p.city
+          FROM jsonb_to_recordset(payload) AS p(partner_id bigint, state_id integer, state_name text, city text)
+         WHERE v.partner_id = p.partner_id
+           AND (v.state_id, v.state_name, v.city) IS DISTINCT FROM (p.state_id, p.state_name, p.city)
+        RETURNING 1
+    )
+    SELECT count(*) FROM actualizadas;
+$$;
+
+-- Partners distintos con su número de líneas (actualizar_provincias_supabase.py).
+-- Devuelve un único jsonb {total, partners: {partner_id: n}}: un valor escalar no lo
+-- corta el "Max rows" de PostgREST aunque haya miles de partners.
+CREATE OR REPLACE FUNCTION partner_line_counts(p_table text)
+RETURNS jsonb
+LANGUAGE plpgsql STABLE
+AS $$
+DECLARE
+    resultado jsonb;
+BEGIN
+    IF p_table NOT IN ('sales_lines', 'ventas_odoo_2025') THEN
+        RAISE EXCEPTION 'Tabla no permitida: %', p_table;
+    END IF;
+    EXECUTE format($q$
+        SELECT jsonb_build_object(
+            'total', (SELECT count(*) FROM %1$I),
+            'partners', coalesce((
+                SELECT jsonb_object_agg(partner_id, n) FROM (
+                    SELECT partner_id, count(*) AS n FROM %1$I WHERE partner_id IS NOT NULL GROUP BY partner_id
+                ) p
+            ), '{}'::jsonb)
+        )
+    $q$, p_table) INTO resultado;
+    RETURN resultado;
+END;
+$$;
+
+CREATE INDEX IF NOT EXISTS idx_ventas_2025_partner_id ON ventas_odoo_2025(partner_id);